@@ -1,16 +1,201 @@
 from pathlib import Path
-from glob import glob
+import fnmatch
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
 import numpy as np
+import os
+import re
+import shlex
 import shutil
 import subprocess
 
-import MDAnalysis as mda
+from utils import find_target_structures, format_residues, get_sel, load_universe, select_residues # noqa: F401 (get_sel is re-exported for existing callers)
+
+_LAMBDA_KEYS_PATTERN = re.compile(r"^.*?(mbar_states|mbar_lambda\((\d+)\)|clambda).*\n?", re.M)
+_PLACEHOLDER_PATTERN = re.compile(r"AAA|CCC")
+_PARALLEL_MIN_ITEMS = 4 # Smaller batches are not worth starting a thread pool for
+_FICLONE = 0x40049409 # Linux ioctl request for a copy-on-write clone of a file
+_NO_REFLINK_DEVICES = set() # Destination devices (st_dev) where a reflink has already failed
+_AMBER2DATS_LINE_TEMPLATE = "edgembar-amber2dats.py -r %(edge_path)s/%(sim_sys)s/remt%(trial)s.log --odir=%(analysis_dir)s %(mdouts)s > %(logs_dir)s/%(edge)s_%(sim_sys)s_t%(trial)s.log 2>&1 &\n"
+_GROUPFILE_LINE_TEMPLATE = "-O -p unisc.parm7 -c %(prevtag)s/%(L)s_%(prevstep)s.rst7 -i inputs/%(L)s_%(step)s.mdin -o %(tag)s/%(L)s_%(step)s.mdout -r %(tag)s/%(L)s_%(step)s.rst7 -x %(tag)s/%(L)s_%(step)s.nc -ref %(prevtag)s/%(L)s_%(prevstep)s.rst7\n"
+
+def _scan_files(directory, prefix="", suffix=""):
+    """ Returns the sorted paths of the files in a directory that match a prefix and suffix
+    
+    Parameters
+    ----------
+    directory : str or Path
+        The directory to scan
+    prefix : str
+        The prefix the file name must start with
+    suffix : str
+        The suffix the file name must end with
+    
+    Returns
+    -------
+    list
+        The sorted list of matching file paths (empty if the directory does not exist)
+
+    """
+    try:
+        with os.scandir(directory) as it:
+            return sorted(entry.path for entry in it
+                          if not entry.name.startswith(".")
+                          and entry.name.startswith(prefix)
+                          and entry.name.endswith(suffix)
+                          and entry.is_file())
+    except FileNotFoundError:
+        return []
+
+def _map_parallel(func, items, parallel=None):
+    """ Applies a function to every item, using a thread pool for the file I/O of larger batches 
+    
+    Parameters
+    ----------
+    func : callable
+        The function to call with each item
+    items : list
+        The items to apply the function to
+    parallel : bool or None
+        Whether to use a thread pool. If None, threads are used for 4 or more items
+    
+    Returns
+    -------
+    list
+        The results of the function for each item, in item order
+
+    """
+    if parallel is None:
+        parallel = len(items) >= _PARALLEL_MIN_ITEMS
+    if not parallel or len(items) == 0:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(32, len(items))) as ex:
+        return list(ex.map(func, items))
+
+def _params_pattern(new_params):
+    """ Compiles a pattern matching any line of an mdin file that assigns one of the parameters
+    
+    Parameters
+    ----------
+    new_params : dict
+        The new parameters to use
+    
+    Returns
+    -------
+    re.Pattern
+        The compiled pattern, with the assigned parameter as its first group
+
+    """
+    keys = sorted(new_params.keys(), key=len, reverse=True)
+    return re.compile(r"^[ \t]*(" + "|".join(map(re.escape, keys)) + r")(?=[ \t]*=).*$", re.M)
+
+@functools.lru_cache(maxsize=None)
+def _load_lambda_schedule(name, nlambda):
+    """ Loads the lambda schedule of an edge from set_lambda_schedule, once per process
+    
+    Parameters
+    ----------
+    name : str
+        The name of the edge
+    nlambda : int
+        The number of lambda values in the schedule
+    
+    Returns
+    -------
+    np.ndarray or None
+        The lambda schedule, or None if no schedule file exists
+
+    """
+    check_lambda = Path(f"set_lambda_schedule/{name}_ar_{nlambda}.txt")
+    if not check_lambda.exists():
+        return None
+    return np.loadtxt(check_lambda, dtype=np.float64)
+
+@functools.lru_cache(maxsize=None)
+def _load_lambda_line(name, nlambda):
+    """ Formats the lambda schedule of an edge for the CCC placeholder of a template, once per process
+    
+    Parameters
+    ----------
+    name : str
+        The name of the edge
+    nlambda : int
+        The number of lambda values in the schedule
+    
+    Returns
+    -------
+    str or None
+        The formatted lambda schedule, or None if no schedule file exists
+
+    """
+    lambda_schedule = _load_lambda_schedule(name, nlambda)
+    if lambda_schedule is None:
+        return None
+    lambda_line = " ".join(["%.8f"] * len(lambda_schedule)) % tuple(lambda_schedule)
+    return f"({lambda_line})\n"
+
+def _reflink_copy(src, dst):
+    """ Copies a file as a copy-on-write reflink where the filesystem supports it, falling back to shutil.copy2
+    
+    Parameters
+    ----------
+    src : str
+        The path to the file to copy
+    dst : str
+        The path to copy the file to
+    
+    Returns
+    -------
+    str
+        The path to the copied file
+
+    """
+    # Filesystems without reflinks fail every attempt, so after the first failure a device goes straight to copy2
+    device = os.stat(os.path.dirname(dst) or ".").st_dev
+    if device in _NO_REFLINK_DEVICES:
+        return shutil.copy2(src, dst)
+    try:
+        import fcntl
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+        return dst
+    except (ImportError, OSError):
+        _NO_REFLINK_DEVICES.add(device)
+        return shutil.copy2(src, dst)
 
 class Calculation:
+    __slots__ = ("system", "edgepath", "edges")
+    _found = {}
+
     def __init__(self, system):
         self.system = system
+        self.edgepath = Path(f"{self.system}/unified/run")
         self.edges = []
         return
+
+    @classmethod
+    def from_system(cls, system):
+        """ Returns a calculation with its edges found, reusing an earlier scan of the same system 
+        
+        Parameters
+        ----------
+        system : str
+            The name of the system
+        
+        Returns
+        -------
+        Calculation
+            The calculation for the system
+
+        """
+        # No system (e.g. rmsd_apply without a reference) is cached as its own empty calculation
+        key = None if system is None else str(Path(system))
+        if key not in cls._found:
+            calculation = cls(system)
+            calculation.find_edges()
+            cls._found[key] = calculation
+        return cls._found[key]
     
     def add_edge(self, edge_object):
         """ Adds an edge to the calculation 
@@ -29,17 +214,42 @@ class Calculation:
 
     def find_edges(self):
         """ Finds all edges in the calculation and adds them to the calculation object"""
-        edgepath = Path(f"{self.system}/unified/run")
-        for edge in glob(f"{edgepath}/*"):
-            self.add_edge(Edge(edge, self.system))
+        if len(self.edges) > 0:
+            return
+        try:
+            with os.scandir(self.edgepath) as it:
+                for entry in it:
+                    if not entry.name.startswith(".") and entry.is_dir():
+                        self.add_edge(Edge(entry.path, self.system, check_exists=False))
+        except FileNotFoundError:
+            # No run directory means no edges, callers that need edges check with _check_edges
+            return
 
 
     def _check_edges(self):
         """ Checks if there are any edges in the calculation """
         if len(self.edges) == 0:
             raise ValueError("No edges found.")
+
+    def _map_edges(self, func, parallel=None):
+        """ Applies a function to every edge, using a thread pool for the file I/O of larger networks 
+        
+        Parameters
+        ----------
+        func : callable
+            The function to call with each edge
+        parallel : bool or None
+            Whether to use a thread pool. If None, threads are used for networks with 4 or more edges
+        
+        Returns
+        -------
+        list
+            The results of the function for each edge, in edge order
+
+        """
+        return _map_parallel(func, self.edges, parallel=parallel)
     
-    def write_calculation_submissions(self, aqtemplate, comtemplate, tag, nlambda=16):
+    def write_calculation_submissions(self, aqtemplate, comtemplate, tag, nlambda=16, parallel=None):
         """ Copies a template file and replaces placeholders with edge-specific values
         
         Parameters
@@ -54,6 +264,8 @@ class Calculation:
             The trial number to use in the file name
         nlambda : int
             The number of lambda values to use in the calculation
+        parallel : bool or None
+            Whether to write the edges in parallel (default: only for 4 or more edges)
         
         Returns
         -------
@@ -61,8 +273,9 @@ class Calculation:
 
         """
         self._check_edges()
-        for edge in self.edges:
-            edge.replace_from_template(aqtemplate, comtemplate, tag=tag, nlambda=nlambda)
+        aq_text = Path(aqtemplate).read_text()
+        com_text = Path(comtemplate).read_text()
+        self._map_edges(lambda edge: edge.replace_from_template_text(aq_text, com_text, tag=tag, nlambda=nlambda), parallel=parallel)
         
 
     def write_network_submission(self, filename="submit_runs.sh"):
@@ -80,17 +293,15 @@ class Calculation:
 
         """
         self._check_edges()
-        with open(filename,'w') as f:
-            f.write("#!/bin/bash\n")
-            for edge in self.edges:
-                lines = edge.get_submission()
-                for line in lines:
-                    f.write(line)
+        parts = ["#!/bin/bash\n"]
+        for edge in self.edges:
+            parts.append(edge.get_submission())
+        Path(filename).write_text("".join(parts))
 
         print(f"To submit calculation, run: \n bash {filename}")
         return
     
-    def copy_edges(self, new_system, ntrials=1, nlambda=16):
+    def copy_edges(self, new_system, ntrials=1, nlambda=16, parallel=None):
         """ Copies the edges to a new system 
         
         Parameters
@@ -101,6 +312,8 @@ class Calculation:
             The number of trials to copy
         nlambda : int
             The number of lambda values to use in the calculation
+        parallel : bool or None
+            Whether to copy the edges in parallel (default: only for 4 or more edges)
         
         Returns
         -------
@@ -108,11 +321,11 @@ class Calculation:
 
         """
         new_system_path = Path(new_system)
-        for edge in self.edges:
-            edge.copy(new_system_path, ntrials=ntrials, nlambda=nlambda)
+        Calculation._found.pop(str(new_system_path), None)
+        self._map_edges(lambda edge: edge.copy(new_system_path, ntrials=ntrials, nlambda=nlambda), parallel=parallel)
         return
 
-    def change_all_params(self, which="all", new_params={}, endpoints_only=False):
+    def change_all_params(self, which="all", new_params={}, endpoints_only=False, parallel=None):
         """ Replaces parameters in the mdin files for all edges in the calculation 
         
         Parameters
@@ -121,6 +334,8 @@ class Calculation:
             Which files to replace the parameters in
         new_params : dict
             The new parameters to use
+        parallel : bool or None
+            Whether to update the edges in parallel (default: only for 4 or more edges)
         
         Returns
         -------
@@ -128,8 +343,11 @@ class Calculation:
 
         """
         self._check_edges()
-        for edge in self.edges:
-            edge.change_mdin_params(which=which, new_params=new_params, endpoints=endpoints_only)
+        if parallel is None:
+            parallel = len(self.edges) >= _PARALLEL_MIN_ITEMS
+        # Only one level of threads: edges in parallel, or the files of each edge in parallel
+        file_parallel = False if parallel else None
+        self._map_edges(lambda edge: edge.change_mdin_params(which=which, new_params=new_params, endpoints=endpoints_only, parallel=file_parallel), parallel=parallel)
         return
 
 
@@ -145,9 +363,11 @@ class Edge:
     self.name : str, the name of the edge in the form (Node1~Node2)
     
     """
-    def __init__(self, path, system):
+    __slots__ = ("path", "com", "aq", "name", "system", "submissions", "endpoints")
+
+    def __init__(self, path, system, check_exists=True):
         self.path = Path(path)
-        if not self.path.exists():
+        if check_exists and not self.path.exists():
             raise FileNotFoundError(f"Path {self.path} does not exist.")
         self.com = self.path / "com"
         self.aq = self.path / "aq"
@@ -155,6 +375,38 @@ class Edge:
         self.system = str(system)
         self.submissions = {"aq": None, "com": None}
         self.endpoints = [0.00000000, 1.00000000]
+
+    def get_lambda_schedule(self, nlambda=16):
+        """ Returns the lambda schedule for the edge, reading the schedule file at most once
+        
+        Parameters
+        ----------
+        nlambda : int
+            The number of lambda values in the schedule
+        
+        Returns
+        -------
+        np.ndarray or None
+            The lambda schedule, or None if no schedule file exists
+
+        """
+        return _load_lambda_schedule(self.name, nlambda)
+
+    def get_lambda_line(self, nlambda=16):
+        """ Returns the lambda schedule formatted for the CCC placeholder of a template
+        
+        Parameters
+        ----------
+        nlambda : int
+            The number of lambda values in the schedule
+        
+        Returns
+        -------
+        str or None
+            The formatted lambda schedule, or None if no schedule file exists
+
+        """
+        return _load_lambda_line(self.name, nlambda)
     
     def replace_from_template(self, aqtemplate, comtemplate, tag="equil", nlambda=16):
         """ Replaces placeholders in a template file with edge-specific values
@@ -174,47 +426,51 @@ class Edge:
         -------
         None
         """
-        for tv, template in enumerate([aqtemplate, comtemplate]):
-            with open(template,"r") as f:
-                content = f.readlines()
-            lines = []
-            check_lambda = Path(f"set_lambda_schedule/{self.name}_ar_{nlambda}.txt")
-            if check_lambda.exists():
-                lambda_schedule = np.genfromtxt(check_lambda)
-                lambda_line = " ".join([f"{x:0.8f}" for x in lambda_schedule])
-                lambda_line = f"({lambda_line})\n"
-            for line in content:
-                if "AAA" in line:
-                    line = line.replace("AAA", self.name)
-                if check_lambda.exists():
-                    if "CCC" in line:
-                        line = line.replace("CCC", lambda_line)
-                lines.append(line)
+        self.replace_from_template_text(Path(aqtemplate).read_text(), Path(comtemplate).read_text(), tag=tag, nlambda=nlambda)
+
+    def replace_from_template_text(self, aq_text, com_text, tag="equil", nlambda=16):
+        """ Replaces placeholders in already-read template text with edge-specific values
+        
+        Parameters
+        ----------
+        aq_text : str
+            The contents of the template file for the aq folder
+        com_text : str
+            The contents of the template file for the com folder
+        tag : str
+            The tag to use in the file name
+        nlambda : int
+            The number of lambda values to use in the calculation
+        
+        Returns
+        -------
+        None
+        """
+        # Only look up the lambda schedule if a template has a place to put it
+        lambda_line = None
+        if "CCC" in aq_text or "CCC" in com_text:
+            lambda_line = self.get_lambda_line(nlambda)
+        replacements = {"AAA": self.name, "CCC": "CCC" if lambda_line is None else lambda_line}
+        for tv, text in enumerate([aq_text, com_text]):
+            text = _PLACEHOLDER_PATTERN.sub(lambda m: replacements[m.group()], text)
             if tv == 0:
-                with open(self.aq / f"aq_{tag}.sh", "w") as f:
-                    f.write("".join(lines))
+                (self.aq / f"aq_{tag}.sh").write_text(text)
                 self.submissions["aq"]=f"aq_{tag}.sh"
             else:
-                with open(self.com / f"{tag}.sh", "w") as f:
-                    f.write("".join(lines))
+                (self.com / f"{tag}.sh").write_text(text)
                 self.submissions["com"]=f"{tag}.sh"
 
     def get_submission(self):
-        """ Returns a list of submission commands for the edge 
+        """ Returns the submission commands for the edge 
         
         Returns
         -------
-        list
-            A list of submission commands
+        str
+            The submission commands, one per line
         
         """
-        lines = []
-        for key in self.submissions.keys():
-            if self.submissions[key] is not None:
-                lines.append(f"cd {self.__dict__[key]}\n")
-                lines.append(f"sbatch {self.submissions[key]}\n")
-                lines.append("cd -\n")
-        return lines
+        return "".join(f"cd {getattr(self, key)}\nsbatch {submission}\ncd -\n"
+                       for key, submission in self.submissions.items() if submission is not None)
     
     def copy(self, new_system_path, ntrials=1, nlambda=16):
         """ Copies the edge to a new system 
@@ -230,13 +486,15 @@ class Edge:
 
         """
         new_edge = new_system_path / "unified" / "run" / self.name
+        lambda_schedule = self.get_lambda_schedule(nlambda)
+        if lambda_schedule is None:
+            raise FileNotFoundError(f"No lambda schedule found for {self.name} with {nlambda} lambdas.")
         for sys in ["aq","com"]:
             print("Working on ", sys)
-            input_dir = self.__dict__[sys]
+            input_dir = getattr(self, sys)
             output_dir = new_edge / sys
             output_dir.mkdir(parents=True, exist_ok=True)
 
-            lambda_schedule = np.genfromtxt(f"set_lambda_schedule/{self.name}_ar_{nlambda}.txt")
             print(f"Copying {input_dir} to {output_dir}")
             ti = NewLambdaSchedule(input_dir, output_dir, lambda_schedule=lambda_schedule, ntrials=ntrials)
             ti.find_all_files()
@@ -244,7 +502,7 @@ class Edge:
             ti.write_group_files()
         return
     
-    def change_mdin_params(self, which="all", new_params={}, endpoints="False"):
+    def change_mdin_params(self, which="all", new_params={}, endpoints="False", parallel=None):
         """ Replace parameters in the mdin files for the edge 
         
         Parameters
@@ -255,6 +513,8 @@ class Edge:
             The new parameters to use
         endpoints : bool
             Whether to only change the endpoints
+        parallel : bool or None
+            Whether to update the files in parallel (default: only for 4 or more files)
         
         Returns
         -------
@@ -264,30 +524,25 @@ class Edge:
         if len(new_params.keys()) == 0:
             print("No new parameters to update.")
             return
+        suffix = ".mdin" if which == "all" else f"{which}.mdin"
+        pattern = _params_pattern(new_params)
+        subs = {key: f"{key} = {value}" for key, value in new_params.items()}
+        files = []
         for sys in ["aq", "com"]:
-            files1, files2 = [], []
+            inputs = getattr(self, sys) / "inputs"
             if not endpoints:
-                if which == "all":
-                    files1 = glob(f"{self.__dict__[sys]}/inputs/*.mdin")
-                else:
-                    files1 = glob(f"{self.__dict__[sys]}/inputs/*{which}.mdin")
-                for file in files1:
-                    self.update_mdin(file, new_params)
+                files += _scan_files(inputs, suffix=suffix)
+            elif which == "all":
+                files += _scan_files(inputs, prefix="0.00000000_", suffix=suffix)
+                files += _scan_files(inputs, prefix="1.00000000_", suffix=suffix)
             else:
-                if which == "all":
-                    files1 = glob(f"{self.__dict__[sys]}/inputs/0.00000000_*.mdin")
-                    files2 = glob(f"{self.__dict__[sys]}/inputs/1.00000000_*.mdin")
-                else:
-                    files1 = glob(f"{self.__dict__[sys]}/inputs/0.00000000_{which}.mdin")
-                    files2 = glob(f"{self.__dict__[sys]}/inputs/1.00000000_{which}.mdin")
-                for file in files1:
-                    self.update_mdin(file, new_params)
-                for file in files2:
-                    self.update_mdin(file, new_params)
+                endpoint_files = [str(inputs / f"{lam}_{which}.mdin") for lam in ["0.00000000", "1.00000000"]]
+                files += [file for file in endpoint_files if Path(file).exists()]
 
+        _map_parallel(lambda file: self.update_mdin(file, new_params, pattern=pattern, subs=subs), files, parallel=parallel)
         return
     
-    def update_mdin(self, file, new_params):
+    def update_mdin(self, file, new_params, pattern=None, subs=None):
         """ Update the mdin file with the new parameters 
         
         Parameters
@@ -296,16 +551,19 @@ class Edge:
             The path to the mdin file
         new_params : dict
             The new parameters to use
+        pattern : re.Pattern
+            The compiled pattern for new_params, built if not provided
+        subs : dict
+            The replacement line for each parameter, built if not provided
         
         """
-        with open(file, "r") as f:
-            content = f.readlines()
-        with open(file, 'w') as f:
-            for line in content:
-                for key in new_params.keys():
-                    if key in line:
-                        line = f"{key} = {new_params[key]}\n"
-                f.write(line)
+        if pattern is None:
+            pattern = _params_pattern(new_params)
+        if subs is None:
+            subs = {key: f"{key} = {value}" for key, value in new_params.items()}
+        text = Path(file).read_text()
+        text = pattern.sub(lambda m: subs[m.group(1)], text)
+        Path(file).write_text(text)
         return
     
 
@@ -327,52 +585,104 @@ class NewLambdaSchedule:
         The number of steps to write to the energies.
         
     """
+    __slots__ = ("input_dir", "output_dir", "lambda_schedule", "ntrials", "_files", "_endpoint_files", "_lambda_files", "_lambda_files_by_stem", "_ref_lambda", "_mbar_lines")
+
     def __init__(self, input_dir, output_dir, lambda_schedule=[0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0], ntrials=3):
         self.input_dir = input_dir
         self.output_dir = output_dir
         self.lambda_schedule = lambda_schedule
         self.ntrials = ntrials
+        self._files = None
+        self._endpoint_files = None
+        self._lambda_files = None
+        self._lambda_files_by_stem = None
+        self._ref_lambda = None
+        self._mbar_lines = None
         self.copy_directory()
 
+    @property
+    def files(self):
+        """ All the files in the input directory, found on first use. """
+        if self._files is None:
+            self._find_files()
+        return self._files
+
+    @property
+    def endpoint_files(self):
+        """ The endpoint files in the input directory, found on first use. """
+        if self._endpoint_files is None:
+            self._find_endpoint_files()
+        return self._endpoint_files
+
+    @property
+    def lambda_files(self):
+        """ The files of the reference lambda value, found on first use. """
+        if self._lambda_files is None:
+            self._find_lambda_files()
+        return self._lambda_files
+
+    @property
+    def lambda_files_by_stem(self):
+        """ The files in the input directory grouped by the lambda value that prefixes their name. """
+        if self._lambda_files_by_stem is None:
+            self._find_lambda_files()
+        return self._lambda_files_by_stem
+
+    @property
+    def ref_lambda(self):
+        """ The lambda value whose files are used as the reference for all other values. """
+        if self._ref_lambda is None:
+            self._find_lambda_files()
+        return self._ref_lambda
+
+    @property
+    def mbar_lines(self):
+        """ The mbar_states line and the mbar_lambda lines (keyed by index) for the schedule, built on first use. """
+        if self._mbar_lines is None:
+            mbar_states_line = f"mbar_states = {len(self.lambda_schedule)}\n"
+            mbar_lambda_lines = {i: f"mbar_lambda({i}) = {lambda_value}\n" for i, lambda_value in enumerate(self.lambda_schedule, start=1)}
+            self._mbar_lines = (mbar_states_line, mbar_lambda_lines)
+        return self._mbar_lines
+
     def find_all_files(self):
-        """ Find all the files in the input directory. """
+        """ Find all the files in the input directory. The file lists are also found on first use, so this is optional. """
         self._find_files()
-        self._find_endpoint_files()
         self._find_lambda_files()
         return
     
     def write_new_lambda_schedule(self):
         """ Write the new TI files with the updated lambda schedule. """
+        in_dir, out_dir = str(self.input_dir), str(self.output_dir)
         # Do the end points first
         for file in self.endpoint_files:
-            with open(file, "r") as f:
-                content = f.readlines()
-            with open(file.replace(str(self.input_dir), str(self.output_dir)), "w") as f:
-                if "0.00000000" in file:
-                    out_lines = self._rewrite_file(content, clambda="0.00000000")
-                else:
-                    out_lines = self._rewrite_file(content, clambda="1.00000000")
-                for line in out_lines:
-                    f.write(line)
-        # Do the other lambda values
-        #ref_lambda = str(self.lambda_files[0].split("_")[0]).split("/")[-1]
-        ref_lambda = str(self.lambda_files[0].split("/")[-1].split("_")[0])
+            content = Path(file).read_text()
+            if os.path.basename(file).startswith("0.00000000"):
+                out_text = self._rewrite_file(content, clambda="0.00000000")
+            else:
+                out_text = self._rewrite_file(content, clambda="1.00000000")
+            Path(file.replace(in_dir, out_dir)).write_text(out_text)
+        # Do the other lambda values, splitting each output path around the reference lambda once
+        ref_lambda = self.ref_lambda
+        templates = [(Path(file).read_text(), file.replace(in_dir, out_dir).split(ref_lambda)) for file in self.lambda_files]
         for lambda_value in self.lambda_schedule[1:-1]:
             fmt_lambda = f"{lambda_value:.8f}"
-            for file in self.lambda_files:
-                with open(file, "r") as f:
-                    content = f.readlines()
-                with open(file.replace(ref_lambda, str(fmt_lambda)).replace(str(self.input_dir), str(self.output_dir)), "w") as f:
-                    out_lines = self._rewrite_file(content, clambda=fmt_lambda)
-                    for line in out_lines:
-                        f.write(line)
+            for content, out_parts in templates:
+                out_text = self._rewrite_file(content, clambda=fmt_lambda)
+                Path(fmt_lambda.join(out_parts)).write_text(out_text)
 
     def copy_directory(self):
-        """ Copy the input directory to the output directory. """
-        ignore_pattern = shutil.ignore_patterns("*.mdout", "t*/*.mdout", "t*/*.nc")
-        shutil.copytree(self.input_dir, self.output_dir, ignore=ignore_pattern, dirs_exist_ok=True)
-        shutil.rmtree(f"{self.output_dir}/inputs")
+        """ Copy the input directory to the output directory, skipping the inputs folder which is regenerated. """
+        input_dir = Path(self.input_dir)
+        def _ignore(src, names):
+            src = Path(src)
+            ignored = set(fnmatch.filter(names, "*.mdout"))
+            if src == input_dir:
+                ignored.add("inputs")
+            return ignored
+        shutil.copytree(self.input_dir, self.output_dir, ignore=_ignore, copy_function=_reflink_copy, dirs_exist_ok=True)
         newpath = Path(f"{self.output_dir}/inputs")
+        if newpath.exists():
+            shutil.rmtree(newpath)
         newpath.mkdir(parents=True, exist_ok=True)
 
     def write_group_files(self):
@@ -380,37 +690,53 @@ class NewLambdaSchedule:
         end_states = ['eqpre1P0', 'eqpre2P0', 'eqP0', 'eqNTP4', 'eqV', 'eqP', 'eqA', 'eqProt2', 'eqProt1', 'eqProt05', 'eqProt025', 'eqProt01', 'eqProt0']
         lambda_states = ['eqATI', 'eqBTI']
         ti_states = ['preTI', 'ti']
+        prev_of = {state: state_order[i-1] for i, state in enumerate(state_order) if i > 0}
+        # Format the lambda values once for every group file
+        ep_schedule = ["0.00000000", "1.00000000"]
+        fmt_schedule = [f"{lambda_value:.8f}" for lambda_value in self.lambda_schedule]
         for end_state in end_states:
-            ep_schedule = [0.00000000, 1.00000000]
-            idx = state_order.index(end_state)
-            out_lines = self.write_group_file_lines(ep_schedule, prevstep=state_order[idx-1], step=end_state, tag="equil", prevtag="equil")
-            with open(f"{self.output_dir}/inputs/equil_{end_state}.groupfile", "w") as f:
-                for line in out_lines:
-                    f.write(line)
+            out_lines = self.write_group_file_lines(ep_schedule, prevstep=prev_of[end_state], step=end_state, tag="equil", prevtag="equil")
+            Path(f"{self.output_dir}/inputs/equil_{end_state}.groupfile").write_text("".join(out_lines))
         for lambda_state in lambda_states:
-            idx = state_order.index(lambda_state)
-            out_lines = self.write_group_file_lines(self.lambda_schedule, prevstep=state_order[idx-1], step=lambda_state, tag="equil", prevtag="equil")
-            with open(f"{self.output_dir}/inputs/equil_{lambda_state}.groupfile", "w") as f:
-                for line in out_lines:
-                    f.write(line)
+            out_lines = self.write_group_file_lines(fmt_schedule, prevstep=prev_of[lambda_state], step=lambda_state, tag="equil", prevtag="equil")
+            Path(f"{self.output_dir}/inputs/equil_{lambda_state}.groupfile").write_text("".join(out_lines))
         for ntrial in range(1, self.ntrials+1):
             for ti_state in ti_states:
-                idx = state_order.index(ti_state)
                 prevtag = ""
                 if ti_state == 'preTI':
                     prevtag = "equil"
                 else:
                     prevtag = "ti"
-                out_lines = self.write_group_file_lines(self.lambda_schedule, prevstep=state_order[idx-1], step=ti_state, tag=f"t{ntrial}", prevtag=prevtag)
-                with open(f"{self.output_dir}/inputs/t{ntrial}_{ti_state}.groupfile", "w") as f:
-                    for line in out_lines:
-                        f.write(line)
+                out_lines = self.write_group_file_lines(fmt_schedule, prevstep=prev_of[ti_state], step=ti_state, tag=f"t{ntrial}", prevtag=prevtag)
+                Path(f"{self.output_dir}/inputs/t{ntrial}_{ti_state}.groupfile").write_text("".join(out_lines))
     
     def write_group_file_lines(self, lambda_schedule=[0.00000000,1.00000000], prevstep="eqATI", step="preTI", tag="equil", prevtag="equil"):
+        """ Returns the group file lines for a step 
+        
+        Parameters
+        ----------
+        lambda_schedule : list
+            The lambda values. Values that are already strings are used as given, others are formatted with 8 decimals.
+        prevstep : str
+            The step the restart files are read from.
+        step : str
+            The step to run.
+        tag : str
+            The output directory of the step.
+        prevtag : str
+            The output directory of the previous step.
+        
+        Returns
+        -------
+        out_lines : list
+            The lines of the group file.
+        
+        """
+        fields = {"prevtag": prevtag, "prevstep": prevstep, "step": step, "tag": tag}
         out_lines = []
         for lambda_value in lambda_schedule:
-            line = f"-O -p unisc.parm7 -c {prevtag}/{lambda_value:.8f}_{prevstep}.rst7 -i inputs/{lambda_value:.8f}_{step}.mdin -o {tag}/{lambda_value:.8f}_{step}.mdout -r {tag}/{lambda_value:.8f}_{step}.rst7 -x {tag}/{lambda_value:.8f}_{step}.nc -ref {prevtag}/{lambda_value:.8f}_{prevstep}.rst7\n"
-            out_lines.append(line)
+            fields["L"] = lambda_value if isinstance(lambda_value, str) else "%.8f" % lambda_value
+            out_lines.append(_GROUPFILE_LINE_TEMPLATE % fields)
         return out_lines
     
             
@@ -420,53 +746,64 @@ class NewLambdaSchedule:
         
         Parameters
         ----------
-        content : list
-            The lines of the original file.
+        content : str
+            The text of the original file.
         clambda : str
             The lambda value to use in the new file.
         
         Returns
         -------
-        out_lines : list
-            The lines of the new file.
+        out_text : str
+            The text of the new file.
             
         """
-        out_lines = []
-        for line in content:
-            if "mbar_states" in line:
-                line = f"mbar_states = {len(self.lambda_schedule)}\n"
-            if "mbar_lambda(" in line:
-                temp = int(line.split("(")[1].split(")")[0])
-                if temp <= len(self.lambda_schedule):
-                    line = f"mbar_lambda({temp}) = {self.lambda_schedule[temp-1]}\n"
-                else:
-                    line = ""
-            if "clambda" in line:
-                line = f"clambda = {clambda}\n"
-            out_lines.append(line)
-        return out_lines
+        mbar_states_line, mbar_lambda_lines = self.mbar_lines
+        clambda_line = f"clambda = {clambda}\n"
+        def _replace(match):
+            if match.group(1) == "mbar_states":
+                return mbar_states_line
+            if match.group(2) is not None:
+                return mbar_lambda_lines.get(int(match.group(2)), "")
+            return clambda_line
+        return _LAMBDA_KEYS_PATTERN.sub(_replace, content)
 
     def _find_files(self):
-        """ Find all the files in the input directory"""
-        self.files = glob(f"{self.input_dir}/inputs/*")
+        """ Find all the files in the input directory, classifying the endpoint files and grouping them by lambda value in the same pass. """
+        self._files = _scan_files(Path(self.input_dir) / "inputs")
+        self._endpoint_files = []
+        self._lambda_files_by_stem = {}
+        for file in self._files:
+            name = os.path.basename(file)
+            if name.startswith(("0.00000000", "1.00000000")):
+                self._endpoint_files.append(file)
+            self._lambda_files_by_stem.setdefault(name.split("_", 1)[0], []).append(file)
         return
     
     def _find_endpoint_files(self):
         """ Find the endpoint files in the input directory. """
-        self.endpoint_files = [f for f in self.files if ("0.00000000" in f or "1.00000000" in f)]
+        self._find_files()
         return
     
     def _find_lambda_files(self):
-        """ Find the lambda files in the input directory. """
-        # Find a single lambda value
-        for file in self.files:
-            if "0.00000000" not in file:
-                start_name = file.split("_")[0]
-                break
-        self.lambda_files = []
-        for file in self.files:
-            if start_name in file:
-                self.lambda_files.append(file)
+        """ Find the lambda files in the input directory, grouped by the lambda value that prefixes their name. """
+        if self._lambda_files_by_stem is None:
+            self._find_files()
+        # Use the files of a single intermediate lambda value as the reference for all other values
+        stems = []
+        for stem in self._lambda_files_by_stem:
+            try:
+                float(stem)
+            except ValueError:
+                continue
+            if stem != "0.00000000":
+                stems.append(stem)
+        interior = [stem for stem in stems if stem != "1.00000000"]
+        if len(interior) > 0:
+            stems = interior
+        if len(stems) == 0:
+            raise ValueError(f"No lambda files found in {self.input_dir}/inputs")
+        self._ref_lambda = sorted(stems)[0]
+        self._lambda_files = self._lambda_files_by_stem[self._ref_lambda]
         return
     
 
@@ -479,13 +816,15 @@ class RMSRestraints:
         The name of the original system
         
     """
+    __slots__ = ("original_system", "storage_dir", "inputs_dir", "outputs_dir", "usetraj", "_restraints_cache")
+
     def __init__(self, original_system, storage_dir="avRMSD", usetraj=False):
-        self.original_system = Calculation(original_system)
-        self.original_system.find_edges()
+        self.original_system = Calculation.from_system(original_system)
         self.storage_dir = Path(storage_dir)
         self.inputs_dir = self.storage_dir/ "inputs"
         self.outputs_dir = self.storage_dir / "outputs"
         self.usetraj = usetraj
+        self._restraints_cache = {}
         if not self.inputs_dir.exists():
             self.inputs_dir.mkdir(parents=True, exist_ok=True)
         if not self.outputs_dir.exists():
@@ -494,14 +833,14 @@ class RMSRestraints:
 
     def GetAverageStructures(self):
         """ Write the cpptraj scripts to get the average structures """
+        self.original_system._check_edges()
         cpptraj_master_lines = []
-        for edge in self.original_system.edges:
-            cpptraj_tmp = self._write_edge_ligand_lines(edge)
+        for cpptraj_tmp in self.original_system._map_edges(self._write_edge_ligand_lines):
             cpptraj_master_lines.extend(cpptraj_tmp)
+        # The stripped target topology is the same for every edge, so it is written only once
+        self._write_target_lines(self.original_system.edges[-1])
         cpptraj_master_lines.append(f"cpptraj -i {self.inputs_dir}/av_tgt.in\n")
-        with open("rmsd_step1_getavstruct.sh", "w") as f:
-            for line in cpptraj_master_lines:
-                f.write(line)
+        Path("rmsd_step1_getavstruct.sh").write_text("".join(cpptraj_master_lines))
         return
     
     def CombineAverageStructures(self):
@@ -515,9 +854,7 @@ class RMSRestraints:
         av_tgt_lines.append(f"rms fit !:1,2,Na+,Cl-,WAT\n")
         av_tgt_lines.append(f"average {self.storage_dir}/av.rst7\n")
         av_tgt_lines.append("run\n")
-        with open(self.inputs_dir / "av_tgt_step2.in", "w") as f:
-            for line in av_tgt_lines:
-                f.write(line)
+        (self.inputs_dir / "av_tgt_step2.in").write_text("".join(av_tgt_lines))
         cpptraj_master_lines.append(f"cpptraj -i {self.inputs_dir}/av_tgt_step2.in\n")
 
         # Writes the cpptraj script to combine the ligand structures with target
@@ -530,14 +867,10 @@ class RMSRestraints:
             av_lig_lines.append(f"combinecrd CRD2 CRD1 parmname Parm-1-2 crdname CRD-1-2\n")
             av_lig_lines.append(f"crdout CRD-1-2 {self.outputs_dir}/av_lig_tgt_{edge.name}.rst7\n")
             av_lig_lines.append(f"run\n")
-            with open(f"{self.inputs_dir}/av_lig_tgt_{edge.name}_step2.in", "w") as f:
-                for line in av_lig_lines:
-                    f.write(line)
+            Path(f"{self.inputs_dir}/av_lig_tgt_{edge.name}_step2.in").write_text("".join(av_lig_lines))
 
             cpptraj_master_lines.append(f"cpptraj -i {self.inputs_dir}/av_lig_tgt_{edge.name}_step2.in\n")
-        with open("rmsd_step_2_combine.sh", "w") as f:
-            for line in cpptraj_master_lines:
-                f.write(line)
+        Path("rmsd_step_2_combine.sh").write_text("".join(cpptraj_master_lines))
         return
     
     def ApplyReferenceToSystem(self, system):
@@ -550,11 +883,8 @@ class RMSRestraints:
         
         """
         print("Applying reference structures to system", system)
-        new_system = Calculation(system)
-        new_system.find_edges()
-        for edge in new_system.edges:
-            print(f"Applying reference to {edge.name}")
-            self._apply_reference_to_edge(edge)
+        new_system = Calculation.from_system(system)
+        new_system._map_edges(self._apply_reference_to_edge)
         return
     
     def _apply_reference_to_edge(self, edge):
@@ -566,18 +896,16 @@ class RMSRestraints:
             The edge to apply the reference structures to.
         
         """
+        print(f"Applying reference to {edge.name}")
         # Modify Group Files
-        for file in glob(f"{edge.com}/inputs/*ti.groupfile"):
-            with open(file, "r") as f:
-                content = f.readlines()
+        for file in _scan_files(edge.com / "inputs", suffix="ti.groupfile"):
+            content = Path(file).read_text().splitlines(keepends=True)
             new_content = []
             for line in content:
                 if "ref" in line:
                     line = line.split("-ref")[0] + f"-ref ../../../../../{self.outputs_dir}/av_lig_tgt_{edge.name}.rst7\n"
                 new_content.append(line)
-            with open(file, "w") as f:
-                for line in new_content:
-                    f.write(line)
+            Path(file).write_text("".join(new_content))
         """
         # Modify Group Files
         for file in glob(f"{edge.com}/inputs/*preTI.groupfile"):
@@ -625,50 +953,120 @@ class RMSRestraints:
                     f.write(line)
         """
 
-        for file in glob(f"{edge.com}/inputs/*preTI.mdin"):
-            with open(file, "r") as f:
-                content = f.readlines()
-            with open(f"restraints_{edge.system}.in", "r") as f:
-                restraints = f.readlines()
-            for line in restraints:
-                if len(line.split("=")) > 1:
-                    line = line.split('=')[0]
-                    for line2 in content:
-                        if line in line2:
-                            print("Removing line: ", line2)
-                            content.remove(line2)
+        restraints, restraint_pattern = self._get_restraints(edge.system)
+        for suffix in ["preTI.mdin", "ti.mdin"]:
+            for file in _scan_files(edge.com / "inputs", suffix=suffix):
+                self._rewrite_mdin_with_restraints(file, restraints, restraint_pattern)
+
+    def _get_restraints(self, system):
+        """ Returns the lines of the restraints file for a system and the pattern matching its keys, reading it at most once 
         
-            with open(file, "w") as f:
-                for line in content:
-                    if "clambda" in line:
-                        for line2 in restraints:
-                            f.write(line2)
-                        f.write("\n")
-                    f.write(line)
+        Parameters
+        ----------
+        system : str
+            The name of the system
         
-        for file in glob(f"{edge.com}/inputs/*ti.mdin"):
-            with open(file, "r") as f:
-                content = f.readlines()
-            with open(f"restraints_{edge.system}.in", "r") as f:
-                restraints = f.readlines()
-            for line in restraints:
-                if len(line.split("=")) > 1:
-                    line = line.split('=')[0]
-                    for line2 in content:
-                        if line in line2:
-                            print("Removing line: ", line2)
-                            content.remove(line2)
+        Returns
+        -------
+        list
+            The lines of restraints_{system}.in
+        re.Pattern or None
+            The pattern matching mdin lines that set any of the restraint keys (None if there are no keys)
+
+        """
+        if system not in self._restraints_cache:
+            restraints = Path(f"restraints_{system}.in").read_text().splitlines(keepends=True)
+            self._restraints_cache[system] = (restraints, self._restraint_keys_pattern(restraints))
+        return self._restraints_cache[system]
+
+    @staticmethod
+    def _restraint_keys_pattern(restraints):
+        """ Returns the pattern matching mdin lines that set any of the restraint keys 
         
-            with open(file, "w") as f:
-                for line in content:
-                    if "clambda" in line:
-                        for line2 in restraints:
-                            f.write(line2)
-                        f.write("\n")
-                    f.write(line)
+        Parameters
+        ----------
+        restraints : list
+            The lines of the restraints file
+        
+        Returns
+        -------
+        re.Pattern or None
+            The compiled pattern, or None if the restraints file sets no keys
 
+        """
+        keys = {line.split("=")[0].strip() for line in restraints if "=" in line}
+        keys.discard("")
+        if len(keys) == 0:
+            return None
+        return re.compile(r"\s*(?:" + "|".join(map(re.escape, keys)) + r")(?=\s*=)")
+
+    def _rewrite_mdin_with_restraints(self, file, restraints, pattern):
+        """ Replaces any restraint keys in an mdin file with the given restraints 
+        
+        Parameters
+        ----------
+        file : str
+            The path to the mdin file
+        restraints : list
+            The lines of the restraints file
+        pattern : re.Pattern or None
+            The pattern matching the restraint keys, from _restraint_keys_pattern
+        
+        """
+        content = Path(file).read_text().splitlines(keepends=True)
+        content = self._remove_restraint_lines(content, pattern)
+
+        new_content = []
+        for line in content:
+            if "clambda" in line:
+                new_content.extend(restraints)
+                new_content.append("\n")
+            new_content.append(line)
+        Path(file).write_text("".join(new_content))
+        return
 
+    def _remove_restraint_lines(self, content, pattern):
+        """ Removes the lines of an mdin file that set any of the restraint keys 
         
+        Parameters
+        ----------
+        content : list
+            The lines of the mdin file
+        pattern : re.Pattern or None
+            The pattern matching the restraint keys, from _restraint_keys_pattern
+        
+        Returns
+        -------
+        list
+            The lines of the mdin file without the restraint keys
+
+        """
+        if pattern is None:
+            return content
+        new_content = []
+        for line in content:
+            if pattern.match(line):
+                print("Removing line: ", line)
+            else:
+                new_content.append(line)
+        return new_content
+
+    def _write_target_lines(self, edge):
+        """ Writes the cpptraj input that strips the ligands to create the target parm file 
+        
+        Parameters
+        ----------
+        edge : Edge
+            The edge whose topology is used
+        
+        """
+        av_tgt_lines = []
+        av_tgt_lines.append(f"parm {edge.com}/unisc.parm7\n")
+        av_tgt_lines.append("parmstrip :1,2\n")
+        av_tgt_lines.append(f"parmwrite out {self.storage_dir}/av_tgt.parm7\n")
+        av_tgt_lines.append("run\n")
+        (self.inputs_dir / "av_tgt.in").write_text("".join(av_tgt_lines))
+        return
 
     def _write_edge_ligand_lines(self, edge):
         """ Returns the lines for the edge-ligand restraint file 
@@ -685,7 +1083,7 @@ class RMSRestraints:
         
         """
         cpptraj_master_lines = []
-        tgt_lines, lig_lines, av_tgt_lines, av_lig_lines = [], [], [], []
+        tgt_lines, lig_lines, av_lig_lines = [], [], []
         tgt_lines.append(f"parm {edge.com}/unisc.parm7\n")
         for lambda_value in edge.endpoints:
             tgt_lines.append(f"trajin {edge.com}/t1/{lambda_value:.8f}_ti.rst7\n")
@@ -705,30 +1103,15 @@ class RMSRestraints:
         lig_lines.append(f"average {self.storage_dir}/av_lig_{edge.name}.rst7 ':1,2'\n")
         lig_lines.append("run\n")
 
-        # Create the tgt parm files
-        av_tgt_lines.append(f"parm {edge.com}/unisc.parm7\n")
-        av_tgt_lines.append("parmstrip :1,2\n")
-        av_tgt_lines.append(f"parmwrite out {self.storage_dir}/av_tgt.parm7\n")
-        av_tgt_lines.append("run\n")
-
         # Create the lig parm files
         av_lig_lines.append(f"parm {edge.com}/unisc.parm7\n")
         av_lig_lines.append(f"parmstrip !:1,2\n")
         av_lig_lines.append(f"parmwrite out {self.storage_dir}/av_lig_{edge.name}.parm7\n")
         av_lig_lines.append("run\n")
 
-        with open(self.inputs_dir / f"tgt_{edge.name}.in", "w") as f:
-            for line in tgt_lines:
-                f.write(line)
-        with open(self.inputs_dir / f"lig_{edge.name}.in", "w") as f:
-            for line in lig_lines:
-                f.write(line)
-        with open(self.inputs_dir / f"av_lig_{edge.name}.in", "w") as f:
-            for line in av_lig_lines:
-                f.write(line)
-        with open(self.inputs_dir / f"av_tgt.in", "w") as f:
-            for line in av_tgt_lines:
-                f.write(line)
+        (self.inputs_dir / f"tgt_{edge.name}.in").write_text("".join(tgt_lines))
+        (self.inputs_dir / f"lig_{edge.name}.in").write_text("".join(lig_lines))
+        (self.inputs_dir / f"av_lig_{edge.name}.in").write_text("".join(av_lig_lines))
         cpptraj_master_lines.append(f"cpptraj -i {self.inputs_dir}/tgt_{edge.name}.in\n")
         cpptraj_master_lines.append(f"cpptraj -i {self.inputs_dir}/lig_{edge.name}.in\n")
         cpptraj_master_lines.append(f"cpptraj -i {self.inputs_dir}/av_lig_{edge.name}.in\n")
@@ -740,8 +1123,7 @@ class RBFE_Analysis:
         self.trials=trials
         self.output_dir = Path(output_dir)
         self.subdir = self.output_dir / subdir
-        self.calculation = Calculation(system)
-        self.calculation.find_edges()
+        self.calculation = Calculation.from_system(system)
         self.num_threads = num_threads
         self.analysis_lines = [f"export PATH={toolkit_bin}/bin:$PATH\n", f"export PYTHONPATH={toolkit_bin}/lib/python3.11/site-packages/:$PYTHONPATH\n"]
         if not self.output_dir.exists():
@@ -752,21 +1134,40 @@ class RBFE_Analysis:
         return 
     def grab_data_lines(self):
         print("Grabbing data lines")
-        (self.output_dir/"logs").mkdir(parents=True, exist_ok=True)
-        if self.output_dir/"logs" is not None:
-            shutil.rmtree(self.output_dir/"logs")
-        (self.output_dir/"logs").mkdir(parents=True, exist_ok=True)
+        logs_dir = self.output_dir / "logs"
+        if logs_dir.exists():
+            shutil.rmtree(logs_dir)
+        logs_dir.mkdir(parents=True)
+        njobs = 0
+        analysis_dirs = set()
+        data_dir = f"{self.output_dir}/data"
+        fields = {"logs_dir": logs_dir}
         for edge in self.calculation.edges:
+            edge_path = str(edge.path)
+            fields["edge"], fields["edge_path"] = edge.name, edge_path
             for sim_sys in ["aq", "com"]:
+                fields["sim_sys"] = sim_sys
                 for trial in self.trials:
-                    analysis_dir = self.output_dir / "data"/ edge.name / sim_sys / f"{trial}"
-                    if not analysis_dir.exists():
-                        analysis_dir.mkdir(parents=True, exist_ok=True)
-                    line=f"edgembar-amber2dats.py -r {edge.path}/{sim_sys}/remt{trial}.log --odir={analysis_dir} $(ls {edge.path}/{sim_sys}/t{trial}/*ti.mdout) > {self.output_dir}/logs/{edge.name}_{sim_sys}_t{trial}.log 2>&1 &\n"
-                    self.analysis_lines.append(line)
+                    analysis_dir = f"{data_dir}/{edge.name}/{sim_sys}/{trial}"
+                    analysis_dirs.add(analysis_dir)
+                    mdouts = _scan_files(f"{edge_path}/{sim_sys}/t{trial}", suffix="ti.mdout")
+                    if len(mdouts) > 0:
+                        mdouts = shlex.join(mdouts)
+                    else:
+                        # Outputs do not exist yet, let bash expand the glob when the script runs
+                        mdouts = f"{edge_path}/{sim_sys}/t{trial}/*ti.mdout"
+                    fields["trial"], fields["analysis_dir"], fields["mdouts"] = trial, analysis_dir, mdouts
+                    self.analysis_lines.append(_AMBER2DATS_LINE_TEMPLATE % fields)
+                    njobs += 1
+                    # Run the background jobs in batches of num_threads rather than all at once
+                    if njobs % self.num_threads == 0:
+                        self.analysis_lines.append("wait\n")
+        # Create each output directory once, after the duplicates have been dropped
+        for analysis_dir in sorted(analysis_dirs):
+            os.makedirs(analysis_dir, exist_ok=True)
         self.analysis_lines.append("wait\n")
         self.analysis_lines.append(f"echo 'Errors below this line:'\n")
-        self.analysis_lines.append(f"grep 'Traceback' {self.output_dir}/logs/*\n")
+        self.analysis_lines.append(f"grep 'Traceback' {logs_dir}/*\n")
         self.analysis_lines.append(f"echo 'End of Errors'\n")
         return
     def discover_edges(self):
@@ -790,8 +1191,7 @@ for edge in edges:
     fname = odir / (edge.name + ".xml")
     edge.WriteXml(fname)
 """
-        with open(f"{self.output_dir}/discover_edges.py", "w") as f:
-            f.write(lines)
+        Path(f"{self.output_dir}/discover_edges.py").write_text(lines)
         self.analysis_lines.append(f"cd {self.output_dir}\n")
         self.analysis_lines.append("python discover_edges.py\n")
         return
@@ -801,15 +1201,13 @@ for edge in edges:
             self.analysis_lines.append(line)
         return
     def write_finalize(self):
-        line = f"edgembar-WriteGraphHtml.py -o analysis/Graph.html -x ../Expt.dat $(ls analysis/*~*.py)\n"
+        line = f"edgembar-WriteGraphHtml.py -o analysis/Graph.html -x ../Expt.dat analysis/*~*.py\n"
         self.analysis_lines.append(line)
         for edge in self.calculation.edges:
             line = f"python analysis/{edge.name}.py\n"
             self.analysis_lines.append(line)
     def write(self):
-        with open("analysis.sh", "w") as f:
-            for line in self.analysis_lines:
-                f.write(line)
+        Path("analysis.sh").write_text("".join(self.analysis_lines))
         print("To run the analysis, run: \n bash analysis.sh")
         return
     
@@ -821,23 +1219,23 @@ for edge in edges:
         optimize_dir = self.output_dir / "optimize"
         if not optimize_dir.exists():
             optimize_dir.mkdir(parents=True, exist_ok=True)
+        data_dir = f"{self.output_dir}/data"
         for edge in self.calculation.edges:
             for sim_sys in ["aq", "com"]:
                 for trial in self.trials:
-                    line = f"fetkutils-tischedule.py --opt {optimize} --ar --ssc --plot {optimize_dir}/{edge.name}_{sim_sys}_ar_{optimize}_{trial}.png -o {optimize_dir}/{edge.name}_{sim_sys}_ar_{optimize}_{trial}.txt  {self.output_dir}/data/{edge.name}/{sim_sys}/{trial}/\n"
+                    line = f"fetkutils-tischedule.py --opt {optimize} --ar --ssc --plot {optimize_dir}/{edge.name}_{sim_sys}_ar_{optimize}_{trial}.png -o {optimize_dir}/{edge.name}_{sim_sys}_ar_{optimize}_{trial}.txt  {data_dir}/{edge.name}/{sim_sys}/{trial}/\n"
                     lines.append(line)
-        with open("optimize.sh", "w") as f:
-            for line in lines:
-                f.write(line)
+        Path("optimize.sh").write_text("".join(lines))
         print("To optimize the lambda schedule, run: \n bash optimize.sh")
         return
     
     def check_optimized(self, optimize=16):
         try:
             optimize_dir = self.output_dir / "optimize"
-            opt_schedule = []
-            for file in glob(f"{str(optimize_dir)}/*_{optimize}_*.txt"):
-                opt_schedule.append(np.genfromtxt(file))
+            key = f"_{optimize}_"
+            files = [file for file in _scan_files(optimize_dir, suffix=".txt") if key in os.path.basename(file)[:-len(".txt")]]
+            # The schedules are small and independent, so larger sets are read on a thread pool
+            opt_schedule = _map_parallel(lambda file: np.loadtxt(file, dtype=np.float64), files)
             if len(opt_schedule)>0:
                 print("Existing optimized lambda schedules found.")
                 print("Averaged Schedule: ", np.mean(opt_schedule, axis=0))
@@ -849,60 +1247,49 @@ for edge in edges:
             print("Exception: No matching lambda schedules found.")
             return False
 
-def format_residues(resids):
-    """ Format a list of residues into a string of ranges."""
-    ranges = []
-    start = resids[0]
-    end = resids[0]
-
-    for resid in resids[1:]:
-        if resid == end + 1:
-            end = resid
-        else:
-            if start == end:
-                ranges.append(f"{start}")
-            else:
-                ranges.append(f"{start}-{end}")
-            start = resid
-            end = resid
-
-    if start == end:
-        ranges.append(f"{start}")
-    else:
-        ranges.append(f"{start}-{end}")
-
-    return ",".join(ranges)
-
-
-def get_sel(mola, molb, mask, systemname="1Y27_rms0"):
-    """ Get the selection of residues for a given edge."""
-    # Load the topology and coordinate files
-    parm7_file = f"{systemname}/unified/run/{mola}~{molb}/com/unisc.parm7"
-    rst7_file = f"avRMSD/outputs/av_lig_tgt_{mola}~{molb}.rst7"
-    u = mda.Universe(parm7_file, rst7_file, topology_format="PARM7", format="RESTRT")
-    t1, t2 = u.select_atoms("resid 1"), u.select_atoms("resid 2")
-    # Define the selection criteria
-    selection = mask
-
-    # Select the residues within 3 Ångströms of residues 1 and 2
-    selected_atoms = u.select_atoms(selection)
-
-    selected_residues = selected_atoms.residues.resids
-    # Sort and find contiguous ranges
-    selected_residues = np.sort(np.unique(selected_residues))
-
-    return set(selected_residues)
-
-def GenDistRestraint(distance, reference_system):
+def _select_group_residues(parm7_file, rst7_files, mask):
+    """ Returns the selected residues for each coordinate file of a topology, parsing the topology once """
+    u = load_universe(parm7_file)
     edge_set = []
-    for file in glob("avRMSD/outputs/av_lig_tgt_*~*.rst7"):
-        ename = file.split("av_lig_tgt_")[-1]
-        edge = ename.split(".")[0]
-        mola, molb = edge.split("~")
-        mask = f'element P and not (around {distance} resid 1 or around {distance} resid 2)'
-        edge_set.append(get_sel(mola,molb,mask, systemname=reference_system))
-    shared_elements = set.intersection(*edge_set)
-    print(format_residues(list(shared_elements)))
+    for rst7_file in rst7_files:
+        u.load_new(rst7_file, format="RESTRT")
+        edge_set.append(select_residues(u, mask))
+    return edge_set
+
+def GenDistRestraint(distance, reference_system, parallel=None):
+    # Group the edges by topology so each distinct parm7 is parsed once and only the coordinates are swapped
+    groups = {}
+    for file, mola, molb in find_target_structures():
+        parm7_file = f"{reference_system}/unified/run/{mola}~{molb}/com/unisc.parm7"
+        groups.setdefault(os.path.realpath(parm7_file), []).append(file)
+    mask = f'element P and not (around {distance} resid 1 or around {distance} resid 2)'
+    # Topology parsing and distance searches are CPU bound, so larger networks are spread over processes
+    if parallel is None:
+        parallel = len(groups) >= 4
+    ex = None
+    if parallel and len(groups) > 1:
+        ex = ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, len(groups)))
+        results = ex.map(_select_group_residues, groups.keys(), groups.values(), [mask] * len(groups))
+    else:
+        results = (_select_group_residues(parm7_file, rst7_files, mask) for parm7_file, rst7_files in groups.items())
+    # Intersect as the selections arrive, stopping once no residue is shared
+    shared_elements = None
+    try:
+        for group_set in results:
+            for residues in group_set:
+                shared_elements = residues if shared_elements is None else np.intersect1d(shared_elements, residues, assume_unique=True)
+            if len(shared_elements) == 0:
+                break
+    finally:
+        if ex is not None:
+            ex.shutdown(cancel_futures=True)
+    if shared_elements is None:
+        print("No averaged target structures found in avRMSD/outputs")
+        return
+    if len(shared_elements) == 0:
+        print("No residues are selected for every edge")
+        return
+    print(format_residues(shared_elements))
 
 
 
@@ -929,12 +1316,10 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     if args.toolkit_bin is not None:
-        with open('toolkit_bin.info','w') as f:
-            f.write(args.toolkit_bin)
+        Path("toolkit_bin.info").write_text(args.toolkit_bin)
     
     if Path("toolkit_bin.info").exists():
-        with open('toolkit_bin.info','r') as f:
-            toolkit_bin = f.read().strip()
+        toolkit_bin = Path("toolkit_bin.info").read_text().strip()
     else:
         toolkit_bin = "./"
 
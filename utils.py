@@ -0,0 +1,60 @@
+import functools
+import numpy as np
+import os
+import re
+
+_AV_LIG_TGT_PATTERN = re.compile(r"av_lig_tgt_([^~]+)~([^.]+)\.rst7$")
+
+
+def format_residues(resids):
+    """ Format a list of residues into a string of ranges."""
+    resids = np.asarray(resids)
+    # A new range starts wherever consecutive residues are not contiguous
+    breaks = np.flatnonzero(np.diff(resids) != 1) + 1
+    starts = np.r_[0, breaks]
+    ends = np.r_[breaks - 1, len(resids) - 1]
+    return ",".join(f"{start}" if start == end else f"{start}-{end}" for start, end in zip(resids[starts].tolist(), resids[ends].tolist()))
+
+
+def find_target_structures(directory="avRMSD/outputs"):
+    """ Returns the path, mola and molb of each averaged target structure (av_lig_tgt_{mola}~{molb}.rst7), sorted by path """
+    structures = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                match = _AV_LIG_TGT_PATTERN.match(entry.name)
+                if match is not None and entry.is_file():
+                    structures.append((entry.path, *match.groups()))
+    except FileNotFoundError:
+        return []
+    return sorted(structures)
+
+
+def load_universe(parm7_file, rst7_file=None):
+    """ Loads a Universe from an Amber topology, with the coordinates of a restart file if one is given """
+    import MDAnalysis as mda # Imported here since it is slow to import and only needed for residue selections
+    if rst7_file is None:
+        return mda.Universe(parm7_file, topology_format="PARM7")
+    return mda.Universe(parm7_file, rst7_file, topology_format="PARM7", format="RESTRT")
+
+
+@functools.lru_cache(maxsize=256)
+def get_sel(mola, molb, mask, systemname="1Y27_rms0"):
+    """ Get the selection of residues for a given edge, once per edge and mask."""
+    # Load the topology and coordinate files
+    parm7_file = f"{systemname}/unified/run/{mola}~{molb}/com/unisc.parm7"
+    rst7_file = f"avRMSD/outputs/av_lig_tgt_{mola}~{molb}.rst7"
+    u = load_universe(parm7_file, rst7_file)
+    selected_residues = select_residues(u, mask)
+    # The cached array is shared by every caller, so it must not be modified in place
+    selected_residues.flags.writeable = False
+    return selected_residues
+
+
+def select_residues(u, mask):
+    """ Returns the sorted residues of a Universe matching a selection mask, at its current coordinates """
+    # Select the residues within the given distance of residues 1 and 2
+    selected_atoms = u.select_atoms(mask)
+
+    # np.unique already returns the residues sorted, ready for finding contiguous ranges
+    return np.unique(selected_atoms.residues.resids)